@@ -120,8 +120,8 @@ def compare_entries(entries1, entries2):
     """
     hashes1, errors1 = hash_entries(entries1)
     hashes2, errors2 = hash_entries(entries2)
-    keys1 = set(hashes1.keys())
-    keys2 = set(hashes2.keys())
+    keys1 = hashes1.keys()
+    keys2 = hashes2.keys()
 
     if errors1 or errors2:
         error = (errors1 + errors2)[0]
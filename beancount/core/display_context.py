@@ -62,7 +62,6 @@ __license__ = "GNU GPLv2"
 
 import collections
 import enum
-import io
 
 from beancount.core.number import Decimal
 from beancount.core import distribution
@@ -184,12 +183,18 @@ class DisplayContext:
         """Set the default value for rendering commas."""
         self.commas = commas
 
-    def __str__(self):
-        oss = io.StringIO()
+    def iter_lines(self):
+        """Generate the lines of the rendered context, one per currency.
+
+        Yields:
+          Strings, each terminated by a newline.
+        """
         linefmt = '{:16}: {}\n'
         for currency, ccontext in sorted(self.ccontexts.items()):
-            oss.write(linefmt.format(currency, ccontext))
-        return oss.getvalue()
+            yield linefmt.format(currency, ccontext)
+
+    def __str__(self):
+        return ''.join(self.iter_lines())
 
     def update(self, number, currency='__default__'):
         """Update the builder with the given number for the given currency.
@@ -56,6 +56,15 @@ class TestDisplayContext(DisplayContextBaseTest):
         dcontext.update(Decimal('7'), 'HOOL')
         self.assertRegex(str(dcontext), 'sign=')
 
+    def test_iter_lines(self):
+        dcontext = display_context.DisplayContext()
+        dcontext.update(Decimal('1.23'), 'USD')
+        dcontext.update(Decimal('7'), 'HOOL')
+        lines = list(dcontext.iter_lines())
+        self.assertEqual(['HOOL', 'USD', '__default__'],
+                         [line.split()[0] for line in lines])
+        self.assertEqual(str(dcontext), ''.join(lines))
+
 
 class TestDisplayContextNatural(DisplayContextBaseTest):
 
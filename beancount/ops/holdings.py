@@ -266,25 +266,32 @@ def aggregate_holdings_list(holdings):
     book_value_seen = False
     market_value_seen = False
     for holding in holdings:
-        units += holding.number
+        number = holding.number
+        units += number
         accounts.add(holding.account)
         price_dates.add(holding.price_date)
         currencies.add(holding.currency)
         cost_currencies.add(holding.cost_currency)
 
-        if holding.book_value is not None:
-            total_book_value += holding.book_value
+        book_value = holding.book_value
+        if book_value is not None:
+            total_book_value += book_value
             book_value_seen = True
-        elif holding.cost_number is not None:
-            total_book_value += holding.number * holding.cost_number
-            book_value_seen = True
-
-        if holding.market_value is not None:
-            total_market_value += holding.market_value
-            market_value_seen = True
-        elif holding.price_number is not None:
-            total_market_value += holding.number * holding.price_number
+        else:
+            cost_number = holding.cost_number
+            if cost_number is not None:
+                total_book_value += number * cost_number
+                book_value_seen = True
+
+        market_value = holding.market_value
+        if market_value is not None:
+            total_market_value += market_value
             market_value_seen = True
+        else:
+            price_number = holding.price_number
+            if price_number is not None:
+                total_market_value += number * price_number
+                market_value_seen = True
 
     if book_value_seen:
         average_cost = total_book_value / units if units else None
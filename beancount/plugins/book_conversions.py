@@ -86,7 +86,6 @@ __license__ = "GNU GPLv2"
 __plugins__ = ('book_price_conversions_plugin',)
 
 import collections
-import copy
 import logging
 import re
 import sys
@@ -95,7 +94,6 @@ import uuid
 from beancount.core.number import ZERO
 from beancount.core import amount
 from beancount.core import position
-from beancount.core import inventory
 from beancount.core import account
 from beancount.core import data
 from beancount import loader
@@ -106,6 +104,9 @@ from beancount.utils import version
 # The name of the metadata field used to link matched postings.
 META = 'trades'
 
+# A regular expression to split the configuration into its two account names.
+_CONFIG_SPLIT_RE = re.compile(r'[,; \t]')
+
 
 # An error in the configuration for this plugin.
 ConfigError = collections.namedtuple('ConfigError', 'source message entry')
@@ -132,22 +133,29 @@ def augment_inventory(pending_lots, posting, entry, eindex):
     """Add the lots from the given posting to the running inventory.
 
     Args:
-      pending_lots: A list of pending ([number], Posting, Transaction) to be matched.
-        The number is modified in-place, destructively.
+      pending_lots: A dict of (currency, cost-currency) to a deque of pending
+        ([number], Posting, Transaction) to be matched. The number is modified
+        in-place, destructively.
       posting: The posting whose position is to be added.
       entry: The parent transaction.
       eindex: The index of the parent transaction housing this posting.
     Returns:
       A new posting with cost basis inserted to be added to a transformed transaction.
     """
-    number = posting.units.number
-    new_posting = posting._replace(
-        units=copy.copy(posting.units),
-        cost=position.Cost(posting.price.number,
-                           posting.price.currency,
-                           entry.date,
-                           None))
-    pending_lots.append(([number], new_posting, eindex))
+    units = posting.units
+    price = posting.price
+    cost_currency = sys.intern(price.currency)
+    new_posting = data.Posting(posting.account,
+                               units,
+                               position.Cost(price.number,
+                                             cost_currency,
+                                             entry.date,
+                                             None),
+                               price,
+                               posting.flag,
+                               posting.meta)
+    pending_lots[(sys.intern(units.currency), cost_currency)].append(
+        ([units.number], new_posting, eindex))
     return new_posting
 
 
@@ -155,8 +163,9 @@ def reduce_inventory(pending_lots, posting, eindex):
     """Match a reducing posting against a list of lots (using FIFO order).
 
     Args:
-      pending_lots: A list of pending ([number], Posting, Transaction) to be matched.
-        The number is modified in-place, destructively.
+      pending_lots: A dict of (currency, cost-currency) to a deque of pending
+        ([number], Posting, Transaction) to be matched. The number is modified
+        in-place, destructively.
       posting: The posting whose position is to be added.
       eindex: The index of the parent transaction housing this posting.
     Returns:
@@ -169,83 +178,108 @@ def reduce_inventory(pending_lots, posting, eindex):
     """
     new_postings = []
     matches = []
-    pnl = ZERO
+    cost_basis = ZERO
     errors = []
 
-    match_number = -posting.units.number
-    match_currency = posting.units.currency
-    cost_currency = posting.price.currency
+    posting_account, units, _, price, flag, meta = posting
+    price_number = price.number
+    match_number = -units.number
+    # Note: the currencies are interned so that the many reducing postings
+    # created below share a single string instance for each.
+    match_currency = sys.intern(units.currency)
+    cost_currency = sys.intern(price.currency)
+    lots = pending_lots[(match_currency, cost_currency)]
     while match_number != ZERO:
 
         # Find the first lot with matching currency.
-        for fnumber, fposting, findex in pending_lots:
-            funits = fposting.units
-            fcost = fposting.cost
-            if (funits.currency == match_currency and
-                fcost and fcost.currency == cost_currency):
-                assert fnumber[0] > ZERO, "Internal error, zero lot"
-                break
-        else:
+        if not lots:
             errors.append(
-                BookConversionError(posting.meta,
+                BookConversionError(meta,
                           "Could not match position {}".format(posting), None))
             break
-
-        # Reduce the pending lots.
-        number = min(match_number, fnumber[0])
-        cost = fcost
+        fnumber, fposting, findex = lots[0]
+        cost = fposting.cost
+        lot_number = fnumber[0]
+        assert lot_number > ZERO, "Internal error, zero lot"
+
+        # Reduce the pending lots. Lots consumed whole, the common case for
+        # large reductions, are simply retired from the queue.
+        if match_number >= lot_number:
+            number = lot_number
+            lots.popleft()
+        else:
+            number = match_number
+            fnumber[0] = lot_number - number
         match_number -= number
-        fnumber[0] -= number
-        if fnumber[0] == ZERO:
-            pending_lots.pop(0)
 
         # Add a corresponding posting.
-        rposting = posting._replace(
-            units=amount.Amount(-number, posting.units.currency),
-            cost=copy.copy(cost))
+        rposting = data.Posting(posting_account,
+                                amount.Amount(-number, match_currency),
+                                cost, price, flag, meta)
         new_postings.append(rposting)
 
-        # Update the P/L.
-        pnl += number * (posting.price.number - cost.number)
+        # Accumulate the cost basis of the reduced lots; the P/L is computed
+        # from it once, after matching.
+        cost_basis += number * cost.number
 
         # Add to the list of matches.
         matches.append(((findex, fposting),
                         (eindex, rposting)))
 
+    # Compute the P/L over all the reduced lots.
+    pnl = (-units.number - match_number) * price_number - cost_basis
+
     return new_postings, matches, pnl, errors
 
 
-def link_entries_with_metadata(entries, all_matches):
+def link_entries_with_metadata(entries, all_matches, posting_indexes):
     """Modify the entries in-place to add matching links to postings.
 
     Args:
       entries: The list of entries to modify.
       all_matches: A list of pairs of (augmenting-posting, reducing-posting).
+      posting_indexes: A dict of id(Posting) to the index of that posting in
+        the list of postings of its parent transaction, for all the matched
+        postings.
     Returns:
       A list of pairs of (index, Posting) for the new (augmenting, reducing)
       annotated postings.
     """
-    # Allocate trade names and compute a map of posting to trade names.
-    link_map = collections.defaultdict(list)
-    for (aug_index, aug_posting), (red_index, red_posting) in all_matches:
-        link = 'trade-{}'.format(str(uuid.uuid4()).split('-')[-1])
-        link_map[id(aug_posting)].append(link)
-        link_map[id(red_posting)].append(link)
-
-    # Modify the postings.
+    # Allocate trade names and compute a map of posting to its comma-separated
+    # trade names, grouped by the index of the entry housing the posting. The
+    # names are made unique with a counter appended to a single random prefix
+    # for this invocation.
+    prefix = uuid.uuid4().hex[-6:]
+    link_map = collections.defaultdict(dict)
+    for mindex, ((aug_index, aug_posting), (red_index, red_posting)) in enumerate(
+            all_matches):
+        link = 'trade-{}{:06x}'.format(prefix, mindex)
+        for eindex, posting_id in ((aug_index, id(aug_posting)),
+                                   (red_index, id(red_posting))):
+            posting_links = link_map[eindex]
+            links_str = posting_links.get(posting_id)
+            posting_links[posting_id] = (link if links_str is None
+                                         else links_str + ',' + link)
+
+    # Modify the postings, visiting only the entries that have matches.
     postings_repl_map = {}
-    for entry in entries:
-        if isinstance(entry, data.Transaction):
-            for index, posting in enumerate(entry.postings):
-                links = link_map.pop(id(posting), None)
-                if links:
-                    new_posting = posting._replace(meta=posting.meta.copy())
-                    new_posting.meta[META] = ','.join(links)
-                    entry.postings[index] = new_posting
-                    postings_repl_map[id(posting)] = new_posting
-
-    # Just a sanity check.
-    assert not link_map, "Internal error: not all matches found."
+    for eindex, posting_links in link_map.items():
+        postings = entries[eindex].postings
+        replacements = {}
+        for posting_id, links_str in posting_links.items():
+            index = posting_indexes[posting_id]
+            posting = postings[index]
+
+            # Just a sanity check.
+            assert id(posting) == posting_id, "Internal error: matched posting moved."
+
+            new_posting = posting._replace(meta={**posting.meta, META: links_str})
+            replacements[index] = new_posting
+            postings_repl_map[posting_id] = new_posting
+
+        # Rebuild the list of postings once for the entry.
+        postings[:] = [replacements.get(index, posting)
+                       for index, posting in enumerate(postings)]
 
     # Return a list of the modified postings (mapping the old matches to the
     # newly created ones).
@@ -271,81 +305,118 @@ def book_price_conversions(entries, assets_account, income_account):
         matches: A list of (number, augmenting-posting, reducing-postings) for all
           matched lots.
     """
-    # Pairs of (Position, Transaction) instances used to match augmenting
-    # entries with reducing ones.
-    pending_lots = []
+    new_entries, errors, mod_matches = _book_price_conversions(
+        entries, assets_account, income_account)
+
+    # Resolve the indexes to their possibly modified Transaction instances.
+    matches = [(data.TxnPosting(new_entries[aug_index], aug_posting),
+                data.TxnPosting(new_entries[red_index], red_posting))
+               for (aug_index, aug_posting), (red_index, red_posting) in mod_matches]
+
+    return new_entries, errors, matches
+
+
+def _book_price_conversions(entries, assets_account, income_account):
+    """Rewrite transactions to insert cost basis, leaving matches unresolved.
+
+    This is the implementation of book_price_conversions(), which the plugin
+    calls directly, as it has no use for the matches.
+
+    Args:
+      See book_price_conversions().
+    Returns:
+      A tuple of
+        entries: A list of new, modified entries.
+        errors: A list of errors generated by this plugin.
+        matches: A list of pairs of (index, Posting) for the (augmenting,
+          reducing) postings of all matched lots.
+    """
+    # Queues of pending lots used to match augmenting entries with reducing
+    # ones, one per (currency, cost-currency) pair.
+    pending_lots = collections.defaultdict(collections.deque)
 
     # A list of pairs of matching (augmenting, reducing) postings.
     all_matches = []
 
-    new_entries = []
+    # A mapping of id(Posting) to the index of each new augmenting and reducing
+    # posting in its replacement transaction, used to link the matches.
+    posting_indexes = {}
+
+    # The metadata attached to the inserted Income legs. Its contents are
+    # always the same, so a single instance is shared between them.
+    income_meta = data.new_metadata('<book_conversions>', 0)
+
+    # Start from a copy of the input list, replacing only the modified entries.
+    new_entries = list(entries)
     errors = []
+    Transaction = data.Transaction
     for eindex, entry in enumerate(entries):
 
-        # Figure out if this transaction has postings in Bitcoins without a cost.
-        # The purpose of this plugin is to fixup those.
-        if isinstance(entry, data.Transaction) and any(is_matching(posting, assets_account)
-                                                       for posting in entry.postings):
-
-            # Segregate the reducing lots, augmenting lots and other lots.
-            augmenting, reducing, other = [], [], []
-            for pindex, posting in enumerate(entry.postings):
-                if is_matching(posting, assets_account):
-                    out = augmenting if posting.units.number >= ZERO else reducing
-                else:
-                    out = other
-                out.append(posting)
-
-            # We will create a replacement list of postings with costs filled
-            # in, possibly more than the original list, to account for the
-            # different lots.
-            new_postings = []
-
-            # Convert all the augmenting postings to cost basis.
-            for posting in augmenting:
-                new_postings.append(augment_inventory(pending_lots, posting, entry, eindex))
-
-            # Then process reducing postings.
-            if reducing:
-                # Process all the reducing postings, booking them to matching lots.
-                pnl = inventory.Inventory()
-                for posting in reducing:
-                    rpostings, matches, posting_pnl, new_errors = (
-                        reduce_inventory(pending_lots, posting, eindex))
-                    new_postings.extend(rpostings)
-                    all_matches.extend(matches)
-                    errors.extend(new_errors)
-                    pnl.add_amount(amount.Amount(posting_pnl, posting.price.currency))
-
-                # If some reducing lots were seen in this transaction, insert an
-                # Income leg to absorb the P/L. We need to do this for each currency
-                # which incurred P/L.
-                if not pnl.is_empty():
-                    for pos in pnl:
-                        meta = data.new_metadata('<book_conversions>', 0)
-                        new_postings.append(
-                            data.Posting(income_account,
-                                         -pos.units, None,
-                                         None, None, meta))
-
-            # Third, add back all the other unrelated legs in.
-            for posting in other:
-                new_postings.append(posting)
-
-            # Create a replacement entry.
-            entry = entry._replace(postings=new_postings)
-
-        new_entries.append(entry)
+        # Note: an exact type check is cheaper than isinstance() on every entry.
+        if type(entry) is not Transaction:
+            continue
 
-    # Add matching metadata to all matching postings.
-    mod_matches = link_entries_with_metadata(new_entries, all_matches)
+        # Segregate the reducing lots, augmenting lots and other lots, in a
+        # single pass over the postings.
+        augmenting, reducing, other = [], [], []
+        for posting in entry.postings:
+            if is_matching(posting, assets_account):
+                out = augmenting if posting.units.number >= ZERO else reducing
+            else:
+                out = other
+            out.append(posting)
+
+        # Figure out if this transaction has postings in Bitcoins without a
+        # cost. The purpose of this plugin is to fixup those.
+        if not (augmenting or reducing):
+            continue
 
-    # Resolve the indexes to their possibly modified Transaction instances.
-    matches = [(data.TxnPosting(new_entries[aug_index], aug_posting),
-                data.TxnPosting(new_entries[red_index], red_posting))
-               for (aug_index, aug_posting), (red_index, red_posting) in mod_matches]
+        # We will create a replacement list of postings with costs filled
+        # in, possibly more than the original list, to account for the
+        # different lots.
+        new_postings = []
+
+        # Convert all the augmenting postings to cost basis.
+        for posting in augmenting:
+            new_posting = augment_inventory(pending_lots, posting, entry, eindex)
+            posting_indexes[id(new_posting)] = len(new_postings)
+            new_postings.append(new_posting)
+
+        # Then process reducing postings.
+        if reducing:
+            # Process all the reducing postings, booking them to matching lots.
+            pnl = collections.defaultdict(lambda: ZERO)
+            for posting in reducing:
+                rpostings, matches, posting_pnl, new_errors = (
+                    reduce_inventory(pending_lots, posting, eindex))
+                for rposting in rpostings:
+                    posting_indexes[id(rposting)] = len(new_postings)
+                    new_postings.append(rposting)
+                all_matches.extend(matches)
+                errors.extend(new_errors)
+                pnl[posting.price.currency] += posting_pnl
+
+            # If some reducing lots were seen in this transaction, insert an
+            # Income leg to absorb the P/L. We need to do this for each currency
+            # which incurred P/L.
+            for currency, number in pnl.items():
+                if number != ZERO:
+                    new_postings.append(
+                        data.Posting(income_account,
+                                     amount.Amount(-number, currency), None,
+                                     None, None, income_meta))
+
+        # Third, add back all the other unrelated legs in.
+        for posting in other:
+            new_postings.append(posting)
+
+        # Create a replacement entry.
+        new_entries[eindex] = entry._replace(postings=new_postings)
 
-    return new_entries, errors, matches
+    # Add matching metadata to all matching postings.
+    mod_matches = link_entries_with_metadata(new_entries, all_matches, posting_indexes)
+
+    return new_entries, errors, mod_matches
 
 
 def extract_trades(entries):
@@ -361,27 +432,25 @@ def extract_trades(entries):
       A list of (number, augmenting-posting, reducing-posting).
     """
     trade_map = collections.defaultdict(list)
+    Transaction = data.Transaction
     for index, entry in enumerate(entries):
-        if not isinstance(entry, data.Transaction):
+        if type(entry) is not Transaction:
             continue
         for posting in entry.postings:
-            links_str = posting.meta.get(META, None)
+            links_str = posting.meta and posting.meta.get(META)
             if links_str:
                 links = links_str.split(',')
                 for link in links:
                     trade_map[link].append((index, entry, posting))
 
     # Sort matches according to the index of the first entry, drop the index
-    # used for doing this, and convert the objects to tuples..
-    trades = [(data.TxnPosting(augmenting[1], augmenting[2]),
-               data.TxnPosting(reducing[1], reducing[2]))
-              for augmenting, reducing in sorted(trade_map.values())]
-
-    # Sanity check.
-    for matches in trades:
-        assert len(matches) == 2
-
-    return trades
+    # used for doing this, and convert the objects to tuples. Unpacking the
+    # pairs also checks that each trade has exactly two postings. The sort is
+    # stable, so trades from the same entry remain in order of appearance.
+    return [(data.TxnPosting(augmenting[1], augmenting[2]),
+             data.TxnPosting(reducing[1], reducing[2]))
+            for augmenting, reducing in sorted(trade_map.values(),
+                                               key=lambda trade: trade[0][0])]
 
 
 def book_price_conversions_plugin(entries, options_map, config):
@@ -401,7 +470,7 @@ def book_price_conversions_plugin(entries, options_map, config):
     # The expected configuration is two account names, separated by whitespace.
     errors = []
     try:
-        assets_account, income_account = re.split(r'[,; \t]', config)
+        assets_account, income_account = _CONFIG_SPLIT_RE.split(config)
         if not account.is_valid(assets_account) or not account.is_valid(income_account):
             raise ValueError("Invalid account string")
     except ValueError as exc:
@@ -412,7 +481,8 @@ def book_price_conversions_plugin(entries, options_map, config):
                 None))
         return entries, errors
 
-    new_entries, errors, _ = book_price_conversions(entries, assets_account, income_account)
+    new_entries, errors, _ = _book_price_conversions(entries,
+                                                     assets_account, income_account)
     return new_entries, errors
 
 
@@ -446,14 +516,16 @@ def main():
               'P/L']
     body = []
     for aug, red in trades:
-        units = -red.posting.units.number
+        red_units = red.posting.units
+        red_price = red.posting.price
+        units = -red_units.number
         buy_price = aug.posting.price.number
-        sell_price = red.posting.price.number
+        sell_price = red_price.number
         pnl = (units * (sell_price - buy_price)).quantize(buy_price)
         body.append([
-            -red.posting.units.number,
-            red.posting.units.currency,
-            red.posting.price.currency,
+            units,
+            red_units.currency,
+            red_price.currency,
             aug.txn.date.isoformat(), buy_price,
             red.txn.date.isoformat(), sell_price,
             pnl
@@ -216,6 +216,61 @@ class TestBookConversions(cmptest.TestCase):
 
         """, entries)
 
+    @loader.load_doc()
+    def test_book_conversions_multiple_currencies(self, entries, errors, __):
+        """
+          2015-01-01 open Assets:Bitcoin
+          2015-01-01 open Income:Bitcoin
+          2015-01-01 open Assets:Bank
+          2015-01-01 open Expenses:Something
+
+          2015-09-04 *
+            Assets:Bank           -500.00 USD
+            Assets:Bitcoin       2.000000 ETH @ 250.00 USD
+
+          2015-09-05 *
+            Assets:Bank           -520.00 USD
+            Assets:Bitcoin       2.000000 BTC @ 260.00 USD
+
+          2015-09-20 *
+            Assets:Bitcoin       -2.000000 BTC @ 280.00 USD
+            Expenses:Something
+
+          2015-09-21 *
+            Assets:Bitcoin       -1.000000 ETH @ 270.00 USD
+            Expenses:Something
+
+        """
+        entries, errors, _ = book_conversions.book_price_conversions(
+            entries, "Assets:Bitcoin", "Income:Bitcoin")
+        self.assertFalse(errors)
+        self.assertEqualEntries("""
+
+          2015-01-01 open Assets:Bitcoin
+          2015-01-01 open Income:Bitcoin
+          2015-01-01 open Assets:Bank
+          2015-01-01 open Expenses:Something
+
+          2015-09-04 *
+            Assets:Bitcoin  2.000000 ETH {250.00 USD} @ 250.00 USD
+            Assets:Bank      -500.00 USD
+
+          2015-09-05 *
+            Assets:Bitcoin  2.000000 BTC {260.00 USD} @ 260.00 USD
+            Assets:Bank      -520.00 USD
+
+          2015-09-20 *
+            Assets:Bitcoin         -2.000000 BTC {260.00 USD} @ 280.00 USD
+            Income:Bitcoin       -40.00000000 USD
+            Expenses:Something  560.00000000 USD
+
+          2015-09-21 *
+            Assets:Bitcoin         -1.000000 ETH {250.00 USD} @ 270.00 USD
+            Income:Bitcoin       -20.00000000 USD
+            Expenses:Something  270.00000000 USD
+
+        """, entries)
+
     @loader.load_doc(expect_errors=True)
     def test_book_conversions_split_partial_failure(self, entries, errors, __):
         """
@@ -32,7 +32,14 @@ __plugins__ = ('add_unrealized_gains',)
 UnrealizedError = collections.namedtuple('UnrealizedError', 'source message entry')
 
 
-def add_unrealized_gains(entries, options_map, subaccount=None):
+# The format of the narration of the unrealized gain transactions.
+NARRATION_FORMAT = (
+    "Unrealized {} for {h.number} units of {h.currency} "
+    "(price: {h.price_number:.4f} {h.cost_currency} as of {h.price_date}, "
+    "average cost: {h.cost_number:.4f} {h.cost_currency})")
+
+
+def add_unrealized_gains(entries, options_map, subaccount=None, price_map=None):
     """Insert entries for unrealized capital gains.
 
     This function inserts entries that represent unrealized gains, at the end of
@@ -47,6 +54,8 @@ def add_unrealized_gains(entries, options_map, subaccount=None):
       subaccount: A string, and optional the name of a subaccount to create
         under an account to book the unrealized gain. If this is left to its
         default value, the gain is booked directly in the same account.
+      price_map: An optional price map, as built by prices.build_price_map(), for
+        the given entries. If not provided, one is built from the entries.
     Returns:
       A list of entries, which includes the new unrealized capital gains entries
       at the end, and a list of errors. The new list of entries is still sorted.
@@ -69,24 +78,34 @@ def add_unrealized_gains(entries, options_map, subaccount=None):
     if not entries:
         return (entries, errors)
 
-    # Group positions by (account, cost, cost_currency).
-    price_map = prices.build_price_map(entries)
+    # Get the latest prices from the entries, unless provided by the caller.
+    if price_map is None:
+        price_map = prices.build_price_map(entries)
     holdings_list = holdings.get_final_holdings(entries, price_map=price_map)
 
-    # Group positions by (account, cost, cost_currency).
-    holdings_list = holdings.aggregate_holdings_by(
-        holdings_list, lambda h: (h.account, h.currency, h.cost_currency))
-
-    # Get the latest prices from the entries.
-    price_map = prices.build_price_map(entries)
+    # Group positions by (account, currency, cost_currency). Each group is
+    # aggregated only as it gets processed below, in (account, currency) order.
+    grouped_holdings = {}
+    for holding in holdings_list:
+        key = (holding.account, holding.currency, holding.cost_currency)
+        key_holdings = grouped_holdings.get(key)
+        if key_holdings is None:
+            grouped_holdings[key] = [holding]
+        else:
+            key_holdings.append(holding)
+    grouped_items = sorted(grouped_holdings.items(), key=lambda item: item[0][:2])
+
+    # A cache of the (asset, income) account names derived from each holding
+    # account.
+    gain_accounts = {}
 
     # Create transactions to account for each position.
     new_entries = []
     latest_date = entries[-1].date
-    for index, holding in enumerate(holdings_list):
-        if (holding.currency == holding.cost_currency or
-            holding.cost_currency is None):
+    for index, ((_, currency, cost_currency), key_holdings) in enumerate(grouped_items):
+        if currency == cost_currency or cost_currency is None:
             continue
+        holding = holdings.aggregate_holdings_list(key_holdings)
 
         # Note: since we're only considering positions held at cost, the
         # transaction that created the position *must* have created at least one
@@ -105,7 +124,7 @@ def add_unrealized_gains(entries, options_map, subaccount=None):
         # Compute the PnL; if there is no profit or loss, we create a
         # corresponding entry anyway.
         pnl = holding.market_value - holding.book_value
-        if holding.number == ZERO:
+        if holding.number.is_zero():
             # If the number of units sum to zero, the holdings should have been
             # zero.
             errors.append(
@@ -118,23 +137,21 @@ def add_unrealized_gains(entries, options_map, subaccount=None):
             continue
 
         # Compute the name of the accounts and add the requested subaccount name
-        # if requested.
-        asset_account = holding.account
-        income_account = account.join(account_types.income,
-                                      account.sans_root(holding.account))
-        if subaccount:
-            asset_account = account.join(asset_account, subaccount)
-            income_account = account.join(income_account, subaccount)
+        # if requested. Many holdings share an account, so cache those names.
+        try:
+            asset_account, income_account = gain_accounts[holding.account]
+        except KeyError:
+            asset_account = holding.account
+            income_account = account.join(account_types.income,
+                                          account.sans_root(holding.account))
+            if subaccount:
+                asset_account = account.join(asset_account, subaccount)
+                income_account = account.join(income_account, subaccount)
+            gain_accounts[holding.account] = (asset_account, income_account)
 
         # Create a new transaction to account for this difference in gain.
         gain_loss_str = "gain" if pnl > ZERO else "loss"
-        narration = ("Unrealized {} for {h.number} units of {h.currency} "
-                     "(price: {h.price_number:.4f} {h.cost_currency} as of {h.price_date}, "
-                     "average cost: {h.cost_number:.4f} {h.cost_currency})").format(
-                         gain_loss_str, h=holding)
-        entry = data.Transaction(data.new_metadata(meta["filename"], lineno=1000 + index),
-                                 latest_date, flags.FLAG_UNREALIZED,
-                                 None, narration, EMPTY_SET, EMPTY_SET, [])
+        narration = NARRATION_FORMAT.format(gain_loss_str, h=holding)
 
         # Book this as income, converting the account name to be the same, but as income.
         # Note: this is a rather convenient but arbitrary choice--maybe it would be best to
@@ -142,38 +159,41 @@ def add_unrealized_gains(entries, options_map, subaccount=None):
         # user specify this.
         #
         # Note: we never set a price because we don't want these to end up in Conversions.
-        entry.postings.extend([
+        postings = [
             data.Posting(
                 asset_account,
-                amount.Amount(pnl, holding.cost_currency),
+                amount.Amount(pnl, cost_currency),
                 None,
                 None,
                 None,
                 None),
             data.Posting(
                 income_account,
-                amount.Amount(-pnl, holding.cost_currency),
+                amount.Amount(-pnl, cost_currency),
                 None,
                 None,
                 None,
                 None)
-        ])
+        ]
+        entry = data.Transaction(data.new_metadata(meta["filename"], lineno=1000 + index),
+                                 latest_date, flags.FLAG_UNREALIZED,
+                                 None, narration, EMPTY_SET, EMPTY_SET, postings)
 
         new_entries.append(entry)
 
     # Ensure that the accounts we're going to use to book the postings exist, by
     # creating open entries for those that we generated that weren't already
     # existing accounts.
+    open_entries = getters.get_account_open_close(entries)
     new_accounts = {posting.account
                     for entry in new_entries
-                    for posting in entry.postings}
-    open_entries = getters.get_account_open_close(entries)
+                    for posting in entry.postings
+                    if posting.account not in open_entries}
     new_open_entries = []
     for account_ in sorted(new_accounts):
-        if account_ not in open_entries:
-            meta = data.new_metadata(meta["filename"], index)
-            open_entry = data.Open(meta, latest_date, account_, None, None)
-            new_open_entries.append(open_entry)
+        meta = data.new_metadata(meta["filename"], index)
+        open_entry = data.Open(meta, latest_date, account_, None, None)
+        new_open_entries.append(open_entry)
 
     return (entries + new_open_entries + new_entries, errors)
 
@@ -186,7 +206,9 @@ def get_unrealized_entries(entries):
     Returns:
       A list of directives, all of which are in the original list.
     """
+    Transaction = data.Transaction
+    flag_unrealized = flags.FLAG_UNREALIZED
     return [entry
             for entry in entries
-            if (isinstance(entry, data.Transaction) and
-                entry.flag == flags.FLAG_UNREALIZED)]
+            if (type(entry) is Transaction and
+                entry.flag == flag_unrealized)]
@@ -8,6 +8,7 @@ from beancount.plugins import unrealized
 from beancount.core.number import D
 from beancount.core.number import ZERO
 from beancount.core import data
+from beancount.core import prices
 from beancount.parser import options
 from beancount.ops import validation
 from beancount import loader
@@ -137,6 +138,28 @@ class TestUnrealized(unittest.TestCase):
         self.assertEqual(D('200'),
                          unreal_entries[0].postings[0].units.number)
 
+    @loader.load_doc()
+    def test_precomputed_price_map(self, entries, _, options_map):
+        """
+        2014-01-01 open Assets:Account1
+        2014-01-01 open Income:Misc
+
+        2014-01-15 *
+          Income:Misc           -1000 USD
+          Assets:Account1       10 HOUSE {100 USD}
+
+        2014-01-15 price HOUSE  120 USD
+        """
+        price_map = prices.build_price_map(entries)
+        new_entries, errors = unrealized.add_unrealized_gains(entries, options_map,
+                                                              price_map=price_map)
+        self.assertEqual((new_entries, errors),
+                         unrealized.add_unrealized_gains(entries, options_map))
+        unreal_entries = unrealized.get_unrealized_entries(new_entries)
+        self.assertEqual(1, len(unreal_entries))
+        self.assertEqual(D('200'),
+                         unreal_entries[0].postings[0].units.number)
+
     @loader.load_doc()
     def test_conversions_only(self, entries, _, options_map):
         """
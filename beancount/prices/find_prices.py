@@ -39,6 +39,12 @@ PriceSource = collections.namedtuple('PriceSource', 'module symbol invert')
 DEFAULT_PACKAGE = 'beancount.prices.sources'
 
 
+# Regular expressions for parsing source map specifications.
+_SOURCE_MAP_SPLIT_RE = re.compile('[ ;]')
+_SOURCE_LIST_RE = re.compile('({}):(.*)$'.format(amount.CURRENCY_RE))
+_SOURCE_RE = re.compile(r'([a-zA-Z]+[a-zA-Z0-9\._]+)/(\^?)([a-zA-Z0-9:=_\-\.]+)$')
+
+
 def format_dated_price_str(dprice):
     """Convert a dated price to a one-line printable string.
 
@@ -91,9 +97,8 @@ def parse_source_map(source_map_spec):
       ValueError: If an invalid pattern has been specified.
     """
     source_map = collections.defaultdict(list)
-    for source_list_spec in re.split('[ ;]', source_map_spec):
-        match = re.match('({}):(.*)$'.format(amount.CURRENCY_RE),
-                         source_list_spec)
+    for source_list_spec in _SOURCE_MAP_SPLIT_RE.split(source_map_spec):
+        match = _SOURCE_LIST_RE.match(source_list_spec)
         if not match:
             raise ValueError('Invalid source map pattern: "{}"'.format(source_list_spec))
 
@@ -121,7 +126,7 @@ def parse_single_source(source):
     Raises:
       ValueError: If invalid.
     """
-    match = re.match(r'([a-zA-Z]+[a-zA-Z0-9\._]+)/(\^?)([a-zA-Z0-9:=_\-\.]+)$', source)
+    match = _SOURCE_RE.match(source)
     if not match:
         raise ValueError('Invalid source name: "{}"'.format(source))
     short_module_name, invert, symbol = match.groups()
@@ -12,6 +12,7 @@ import hashlib
 import os
 import sys
 import logging
+import threading
 from concurrent import futures
 
 from dateutil import tz
@@ -38,6 +39,10 @@ _CACHE = None
 DEFAULT_EXPIRATION = datetime.timedelta(seconds=30*60)  # 30 mins.
 
 
+# The maximum number of prices to fetch concurrently.
+MAX_WORKERS = 32
+
+
 # The default source parser is back.
 DEFAULT_SOURCE = 'beancount.prices.sources.yahoo'
 
@@ -85,7 +90,8 @@ def fetch_cached_price(source, symbol, date):
         key = md5.hexdigest()
         timestamp_now = int(now().timestamp())
         try:
-            timestamp_created, result_naive = _CACHE[key]
+            with _CACHE.lock:
+                timestamp_created, result_naive = _CACHE[key]
 
             # Convert naive timezone to UTC, which is what the cache is always
             # assumed to store. (The reason for this is that timezones from
@@ -117,7 +123,8 @@ def fetch_cached_price(source, symbol, date):
                 result_naive = result
 
             if result_naive is not None:
-                _CACHE[key] = (timestamp_now, result_naive)
+                with _CACHE.lock:
+                    _CACHE[key] = (timestamp_now, result_naive)
     return result
 
 
@@ -139,6 +146,7 @@ def setup_cache(cache_filename, clear_cache):
         global _CACHE
         _CACHE = shelve.open(cache_filename, 'c')
         _CACHE.expiration = DEFAULT_EXPIRATION
+        _CACHE.lock = threading.Lock()  # Note: 'shelve' is not thread-safe.
 
 
 def reset_cache():
@@ -318,9 +326,6 @@ def process_args():
         args.inactive = args.clobber = True
         args.undeclared = DEFAULT_SOURCE
 
-    # Setup for processing.
-    setup_cache(args.cache_filename, args.clear_cache)
-
     # Get the list of DatedPrice jobs to get from the arguments.
     logging.info("Processing at date: %s", args.date or datetime.date.today())
     jobs = []
@@ -344,7 +349,7 @@ def process_args():
     else:
         # Interpret the arguments as Beancount input filenames.
         for filename in args.sources:
-            if not path.exists(filename) or not path.isfile(filename):
+            if not path.isfile(filename):
                 parser.error('File does not exist: "{}"; '
                              'did you mean to use -e?'.format(filename))
                 continue
@@ -363,14 +368,20 @@ def process_args():
 def main():
     args, jobs, entries, dcontext = process_args()
 
+    # Open the cache only when there are prices to be fetched, or when it was
+    # explicitly asked to be cleared (even on a dry run).
+    if args.clear_cache or (jobs and not args.dry_run):
+        setup_cache(args.cache_filename, args.clear_cache)
+
     # If we're just being asked to list the jobs, do this here.
     if args.dry_run:
         for dprice in jobs:
             print(find_prices.format_dated_price_str(dprice))
         return
 
-    # Fetch all the required prices, processing all the jobs.
-    executor = futures.ThreadPoolExecutor(max_workers=3)
+    # Fetch all the required prices, processing all the jobs. The fetches are
+    # bound by network latency, so run up to one per job concurrently.
+    executor = futures.ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(jobs))))
     price_entries = filter(None, executor.map(
         functools.partial(fetch_price, swap_inverted=args.swap_inverted), jobs))
 
@@ -5,8 +5,10 @@ __license__ = "GNU GPLv2"
 
 import csv
 import collections
+import functools
 import io
 import itertools
+import operator
 
 
 # An unrendered table data structure. This is a table-like report data
@@ -21,7 +23,12 @@ import itertools
 #     contents of all the cells of the table body.
 Table = collections.namedtuple('Table', 'columns header body')
 
+# A mapping of format alignment character to the equivalent str method used to
+# pad string cells. Strings are left-aligned by default.
+_STRING_JUSTIFY = {None: str.ljust, '<': str.ljust, '>': str.rjust}
 
+
+@functools.lru_cache(maxsize=256)
 def attribute_to_title(fieldname):
     """Convert programming id into readable field name.
 
@@ -47,44 +54,34 @@ def create_table(rows, field_spec=None):
     Returns:
       A Table instance.
     """
-    # Normalize field_spec to a dict.
+    # Normalize field_spec to a list of (name, header, formatter) triplets, with
+    # a nicely formatted header, in a single pass.
     if field_spec is None:
         namedtuple_class = type(rows[0])
-        field_spec = [(field, None, None)
-                      for field in namedtuple_class._fields]
-
-    elif isinstance(field_spec, (list, tuple)):
-        new_field_spec = []
-        for field in field_spec:
-            if isinstance(field, tuple):
-                assert len(field) <= 3, field
-                if len(field) == 1:
-                    field = field[0]
-                    new_field_spec.append((field, None, None))
-                elif len(field) == 2:
-                    field, header = field
-                    new_field_spec.append((field, header, None))
-                elif len(field) == 3:
-                    new_field_spec.append(field)
+        field_spec = namedtuple_class._fields
+
+    new_field_spec = []
+    for field in field_spec:
+        if isinstance(field, tuple):
+            assert 1 <= len(field) <= 3, field
+            if len(field) == 1:
+                name, header_, formatter = field[0], None, None
+            elif len(field) == 2:
+                (name, header_), formatter = field, None
             else:
-                if isinstance(field, str):
-                    title = attribute_to_title(field)
-                elif isinstance(field, int):
-                    title = "Field {}".format(field)
-                else:
-                    raise ValueError("Invalid type for column name")
-                new_field_spec.append((field, title, None))
-
-        field_spec = new_field_spec
-
-    # Ensure a nicely formatted header.
-    field_spec = [((name, attribute_to_title(name), formatter)
-                   if header_ is None
-                   else (name, header_, formatter))
-                  for (name, header_, formatter) in field_spec]
-
-    assert isinstance(field_spec, list), field_spec
-    assert all(len(x) == 3 for x in field_spec), field_spec
+                name, header_, formatter = field
+            if header_ is None:
+                header_ = attribute_to_title(name)
+        else:
+            if isinstance(field, str):
+                header_ = attribute_to_title(field)
+            elif isinstance(field, int):
+                header_ = "Field {}".format(field)
+            else:
+                raise ValueError("Invalid type for column name")
+            name, formatter = field, None
+        new_field_spec.append((name, header_, formatter))
+    field_spec = new_field_spec
 
     # Compute the column names.
     columns = [name for (name, _, __) in field_spec]
@@ -92,28 +89,53 @@ def create_table(rows, field_spec=None):
     # Compute the table header.
     header = [header_column for (_, header_column, __) in field_spec]
 
-    # Compute the table body.
+    # Compute the table body, fetching all the fields of each row in one call.
+    getter = _create_row_getter(columns)
+    formatters = [formatter for (_, __, formatter) in field_spec]
     body = []
     for row in rows:
-        body_row = []
-        for name, _, formatter in field_spec:
+        body.append([('' if value is None else
+                      str(value) if formatter is None else
+                      formatter(value))
+                     for value, formatter in zip(getter(row), formatters)])
+
+    return Table(columns, header, body)
+
+
+def _create_row_getter(names):
+    """Create a function that fetches the given fields from a row.
+
+    Args:
+      names: A list of field names (strings) or indexes (integers).
+    Returns:
+      A function that accepts a row and returns a tuple of its field values, in
+      the order of the given names.
+    Raises:
+      ValueError: If a name is neither a string nor an integer.
+    """
+    if not names:
+        return lambda row: ()
+
+    if all(isinstance(name, str) for name in names):
+        getter = operator.attrgetter(*names)
+    elif all(isinstance(name, int) for name in names):
+        getter = operator.itemgetter(*names)
+    else:
+        getters = []
+        for name in names:
             if isinstance(name, str):
-                value = getattr(row, name)
+                getters.append(operator.attrgetter(name))
             elif isinstance(name, int):
-                value = row[name]
+                getters.append(operator.itemgetter(name))
             else:
                 raise ValueError("Invalid type for column name")
-            if value is not None:
-                if formatter is not None:
-                    value = formatter(value)
-                else:
-                    value = str(value)
-            else:
-                value = ''
-            body_row.append(value)
-        body.append(body_row)
+        return lambda row: tuple(getter(row) for getter in getters)
 
-    return Table(columns, header, body)
+    # Note: the getters return a bare value rather than a tuple for a single
+    # field.
+    if len(names) == 1:
+        return lambda row: (getter(row),)
+    return getter
 
 
 def table_to_html(table, classes=None, file=None):
@@ -128,32 +150,33 @@ def table_to_html(table, classes=None, file=None):
       A string, the rendered table, or None, if a file object is provided
       to write to.
     """
-    # Initialize file.
-    oss = io.StringIO() if file is None else file
-    oss.write('<table class="{}">\n'.format(' '.join(classes or [])))
+    # Note: the cells are rendered by plain concatenation rather than with
+    # format(). They are not escaped; some formatters render markup, e.g. links.
 
-    # Render header.
+    # Render the table header.
+    fragments = ['<table class="{}">\n'.format(' '.join(classes or []))]
     if table.header:
-        oss.write('  <thead>\n')
-        oss.write('    <tr>\n')
-        for header in table.header:
-            oss.write('      <th>{}</th>\n'.format(header))
-        oss.write('    </tr>\n')
-        oss.write('  </thead>\n')
-
-    # Render body.
-    oss.write('  <tbody>\n')
-    for row in table.body:
-        oss.write('    <tr>\n')
-        for cell in row:
-            oss.write('      <td>{}</td>\n'.format(cell))
-        oss.write('    </tr>\n')
-    oss.write('  </tbody>\n')
-
-    # Render footer.
-    oss.write('</table>\n')
+        fragments.append('  <thead>\n'
+                         '    <tr>\n' +
+                         ''.join('      <th>' + str(header) + '</th>\n'
+                                 for header in table.header) +
+                         '    </tr>\n'
+                         '  </thead>\n')
+
+    # Render body, one string per row.
+    fragments.append('  <tbody>\n')
+    fragments.extend('    <tr>\n' +
+                     ''.join('      <td>' + str(cell) + '</td>\n'
+                             for cell in row) +
+                     '    </tr>\n'
+                     for row in table.body)
+    fragments.append('  </tbody>\n'
+                     '</table>\n')
+
+    # Write out the fragments all at once.
     if file is None:
-        return oss.getvalue()
+        return ''.join(fragments)
+    file.writelines(fragments)
 
 
 def table_to_text(table,
@@ -174,8 +197,11 @@ def table_to_text(table,
     column_widths = compute_table_widths(itertools.chain([table.header],
                                                          table.body))
 
-    # Insert column format chars and compute line formatting string.
+    # Insert column format chars and compute line formatting string. String
+    # cells aligned left or right are padded directly with a str method, which
+    # bypasses the format-spec parser; other cells are rendered with format().
     column_formats = []
+    column_justifies = []
     if formats:
         default_format = formats.get('*', None)
     for column, width in zip(table.columns, column_widths):
@@ -186,20 +212,29 @@ def table_to_text(table,
             else:
                 column_formats.append("{{:{:d}}}".format(width))
         else:
+            format_ = None
             column_formats.append("{{:{:d}}}".format(width))
+        column_justifies.append(_STRING_JUSTIFY.get(format_, None))
+
+    column_specs = list(zip(column_justifies, column_widths, column_formats))
 
-    line_format = column_interspace.join(column_formats) + "\n"
-    separator = line_format.format(*[('-' * width) for width in column_widths])
+    def render_line(row):
+        "Render a single line of cells to a string."
+        return column_interspace.join(
+            justify(cell, width) if justify and isinstance(cell, str) else
+            format_string.format(cell)
+            for (justify, width, format_string), cell in zip(column_specs, row)) + "\n"
+
+    separator = render_line([('-' * width) for width in column_widths])
 
     # Render the header.
     oss = io.StringIO()
     if table.header:
-        oss.write(line_format.format(*table.header))
+        oss.write(render_line(table.header))
 
     # Render the body.
     oss.write(separator)
-    for row in table.body:
-        oss.write(line_format.format(*row))
+    oss.writelines(map(render_line, table.body))
     oss.write(separator)
 
     return oss.getvalue()
@@ -208,6 +243,10 @@ def table_to_text(table,
 def table_to_csv(table, file=None, **kwargs):
     """Render a Table to a CSV file.
 
+    Note that the rows are streamed to the file object if one is provided;
+    prefer this for large tables, as rendering to a string holds the entire
+    contents in memory.
+
     Args:
       table: An instance of a Table.
       file: A file object to write to. If no object is provided, this
@@ -217,14 +256,14 @@ def table_to_csv(table, file=None, **kwargs):
       A string, the rendered table, or None, if a file object is provided
       to write to.
     """
-    output_file = file or io.StringIO()
+    output_file = io.StringIO() if file is None else file
 
     writer = csv.writer(output_file, **kwargs)
     if table.header:
         writer.writerow(table.header)
     writer.writerows(table.body)
 
-    if not file:
+    if file is None:
         return output_file.getvalue()
 
 
@@ -239,20 +278,11 @@ def compute_table_widths(rows):
     Raises:
       IndexError: If the rows are of different lengths.
     """
-    row_iter = iter(rows)
-    first_row = next(row_iter)
-    num_columns = len(first_row)
-    column_widths = [len(cell) for cell in first_row]
-    for row in row_iter:
-        for i, cell in enumerate(row):
-            if not isinstance(cell, str):
-                cell = str(cell)
-            cell_len = len(cell)
-            if cell_len > column_widths[i]:
-                column_widths[i] = cell_len
-        if i+1 != num_columns:
-            raise IndexError("Invalid number of rows")
-    return column_widths
+    # Note: the per-cell work is done by C-level map(), max() and zip() calls.
+    rows = [list(map(str, row)) for row in rows]
+    if len({len(row) for row in rows}) > 1:
+        raise IndexError("Invalid number of rows")
+    return [max(map(len, column)) for column in zip(*rows)]
 
 
 def render_table(table_, output, output_format, css_id=None, css_class=None):
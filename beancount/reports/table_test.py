@@ -45,6 +45,22 @@ class TestTable(unittest.TestCase):
                                            ['CAD', '1333.33']]),
                          table_object)
 
+    def test_create_table_mixed_names(self):
+        Tup = collections.namedtuple('Tup', 'currency amount')
+        tuples = [
+            Tup('USD', D('1111.00')),
+            Tup('CAD', None),
+        ]
+        table_object = table.create_table(tuples, [(0, 'Currency'), 'amount'])
+        self.assertEqual(table.Table(columns=[0, 'amount'],
+                                     header=['Currency', 'Amount'],
+                                     body=[['USD', '1111.00'],
+                                           ['CAD', '']]),
+                         table_object)
+
+        table_object = table.create_table(tuples, ['amount'])
+        self.assertEqual([['1111.00'], ['']], table_object.body)
+
     def test_table_to_html(self):
         table_object = self.test_create_table()
         html = table.table_to_html(table_object, classes=['high-class'])
@@ -82,6 +98,17 @@ class TestTable(unittest.TestCase):
         """)
         self.assertEqual(expected, html)
 
+    def test_table_to_html_markup(self):
+        def render_link(name):
+            "Render a link to a page, as the web formatters do."
+            return '<a href="/event/{0}">{0}</a>'.format(name)
+
+        table_object = table.create_table([('Ev', 1)], [(0, 'Type', render_link),
+                                                        (1, 'Number')])
+        html = table.table_to_html(table_object)
+        self.assertIn('<td><a href="/event/Ev">Ev</a></td>', html)
+        self.assertIn('<td>1</td>', html)
+
     def test_table_to_text(self):
         table_object = self.test_create_table()
         text = table.table_to_text(table_object,
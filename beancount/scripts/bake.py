@@ -9,6 +9,7 @@ __copyright__ = "Copyright (C) 2014-2016  Martin Blais"
 __license__ = "GNU GPLv2"
 
 from os import path
+import concurrent.futures
 import functools
 import importlib
 import logging
@@ -17,8 +18,10 @@ import re
 import shlex
 import shutil
 import subprocess
+import threading
 import zipfile
 
+import lxml.etree
 import lxml.html
 
 from beancount.web import scrape
@@ -29,10 +32,41 @@ from beancount.utils import version
 
 # Directories where binary files are allowed.
 BINARY_DIRECTORIES = ['resources', 'third_party', 'doc']
-BINARY_MATCH = re.compile(r'/({}/|favicon.ico$)'.format(
-    '|'.join(BINARY_DIRECTORIES))).match
+BINARY_PREFIXES = tuple('/{}/'.format(dirname) for dirname in BINARY_DIRECTORIES)
+BINARY_FILES = frozenset(['/favicon.ico'])
 
+# A search for anything that could be an absolute link in an HTML document:
+# attribute values, CSS url() references and CSS imports starting with a slash.
+ABSOLUTE_LINK_SEARCH = re.compile(
+    rb'''(?:=\s*["']?|url\(\s*["']?|@import\s*["'])/''', re.IGNORECASE).search
 
+# The number of threads writing out scraped documents.
+SAVE_WORKERS = 8
+
+# The maximum number of scraped documents waiting to be written out. The
+# scraper blocks when it gets this far ahead of the writers.
+MAX_PENDING_DOCUMENTS = 64
+
+# Per-thread storage for a reusable HTML parser. Parsers are not thread-safe,
+# and calling lxml.html.document_fromstring() without one creates a new parser
+# on every call.
+_PARSER = threading.local()
+
+
+def _get_parser():
+    """Return an HTML parser reserved for the calling thread.
+
+    Returns:
+      An instance of lxml.html.HTMLParser, created on first use in each thread.
+    """
+    try:
+        return _PARSER.parser
+    except AttributeError:
+        parser = _PARSER.parser = lxml.html.HTMLParser()
+        return parser
+
+
+@functools.lru_cache(maxsize=None)
 def normalize_filename(url):
     """Convert URL paths to filenames. Add .html extension if needed.
 
@@ -41,12 +75,53 @@ def normalize_filename(url):
     Returns:
       A string, possibly with an extension appended.
     """
-    if url.endswith('/'):
+    if url.endswith('.html'):
+        return url
+    elif url.endswith('/'):
         return path.join(url, 'index.html')
-    elif BINARY_MATCH(url):
+    elif url.startswith(BINARY_PREFIXES) or url in BINARY_FILES:
         return url
     else:
-        return url if url.endswith('.html') else (url + '.html')
+        return url + '.html'
+
+
+def _fast_relpath(target, start):
+    """Compute a relative path between two absolute URL paths.
+
+    This is equivalent to os.path.relpath() for absolute, slash-separated
+    paths, but skips the generic normalization it performs on every call.
+
+    Args:
+      target: A string, the absolute path to point to.
+      start: A string, the absolute directory to compute the path from.
+    Returns:
+      A string, the relative path from 'start' to 'target'.
+    """
+    # Defer to the general routine for paths with '.' or '..' components.
+    if '/.' in target or '/.' in start:
+        return path.relpath(target, start)
+    target_parts = [part for part in target.split('/') if part]
+    start_parts = [part for part in start.split('/') if part]
+    common = 0
+    for target_part, start_part in zip(target_parts, start_parts):
+        if target_part != start_part:
+            break
+        common += 1
+    rel_parts = ['..'] * (len(start_parts) - common) + target_parts[common:]
+    return '/'.join(rel_parts) if rel_parts else '.'
+
+
+@functools.lru_cache(maxsize=65536)
+def _relativize(current_dir, link):
+    """Convert an absolute link to a file path relative to a directory.
+
+    Args:
+      current_dir: A string, the absolute directory of the referring page.
+      link: A string, the absolute link to convert.
+    Returns:
+      A string, the relative path to the link's output file.
+    """
+    return _fast_relpath(normalize_filename(link), current_dir)
 
 
 def relativize_links(html, current_url):
@@ -57,12 +132,18 @@ def relativize_links(html, current_url):
       current_url: A string, the URL of the current page, a path to.
         a file or a directory. If the path represents a directory, the
         path ends with a /.
+    Returns:
+      A boolean, true if any link was modified.
     """
+    # Gather the absolute links first, so the tree isn't being modified while
+    # lxml walks it.
+    links = [(element, attribute, link)
+             for element, attribute, link, _ in lxml.html.iterlinks(html)
+             if path.isabs(link)]
     current_dir = path.dirname(current_url)
-    for element, attribute, link, pos in lxml.html.iterlinks(html):
-        if path.isabs(link):
-            relative_link = path.relpath(normalize_filename(link), current_dir)
-            element.set(attribute, relative_link)
+    for element, attribute, link in links:
+        element.set(attribute, _relativize(current_dir, link))
+    return bool(links)
 
 
 def remove_links(html, targets):
@@ -70,55 +151,106 @@ def remove_links(html, targets):
 
     Args:
       html: An lxml document node.
-      targets: A set of string, targets to be removed.
+      targets: A set of string, targets to be removed. Other iterables are
+        accepted and converted to a set first.
+    Returns:
+      A boolean, true if any link was removed.
     """
+    if not isinstance(targets, (set, frozenset)):
+        targets = frozenset(targets)
+    modified = False
     for element, attribute, link, pos in lxml.html.iterlinks(html):
         if link in targets:
             del element.attrib[attribute]
             element.tag = 'span'
             element.set('class', 'removed-link')
+            modified = True
+    return modified
 
 
-def save_scraped_document(output_dir, url, response, contents, html_root, skipped_urls):
-    """Callback function to process a document being scraped.
-
-    This converts the document to have relative links and writes out the file to
-    the output directory.
+def render_scraped_document(url, response, contents, html_root, skipped_urls):
+    """Convert a document being scraped to have relative links.
 
     Args:
-      output_dir: A string, the output directory to write.
       url: A string, the originally requested URL.
       response: An http response as per urlopen.
       contents: Bytes, the content of a response.
       html_root: An lxml root node for the document, optionally. If this is provided,
         this avoid you having to reprocess it (for performance reasons).
       skipped_urls: A set of the links from the file that were skipped.
+    Returns:
+      Bytes, the contents to write out for the document, or None, if the document
+      is not to be saved.
     """
     if response.status != 200:
         logging.error("Invalid status: %s", response.status)
 
     # Ignore directories.
     if url.endswith('/'):
-        return
+        return None
 
-    # Note that we're saving the file under the non-redirected URL, because this
-    # will have to be opened using files and there are no redirects that way.
-
-    if response.info().get_content_type() == 'text/html':
+    # Pages without any absolute link and nothing to remove are left untouched,
+    # so skip parsing and walking their links.
+    if (response.info().get_content_type() == 'text/html' and
+            (skipped_urls or ABSOLUTE_LINK_SEARCH(contents))):
         if html_root is None:
-            html_root = lxml.html.document_fromstring(contents)
-        remove_links(html_root, skipped_urls)
-        relativize_links(html_root, url)
-        contents = lxml.html.tostring(html_root, method="html")
+            html_root = lxml.html.document_fromstring(contents, parser=_get_parser())
+        # Note: Both functions have to run; don't short-circuit them.
+        removed = remove_links(html_root, skipped_urls)
+        relativized = relativize_links(html_root, url)
+        if removed or relativized:
+            contents = lxml.html.tostring(html_root, method="html")
+    return contents
+
+
+def write_document(output_dir, url, contents, made_dirs=None):
+    """Write out the contents of a document to the output directory.
 
-    # Compute output filename and write out the relativized contents.
+    Note that the file is saved under the non-redirected URL, because this will
+    have to be opened using files and there are no redirects that way.
+
+    Args:
+      output_dir: A string, the output directory to write.
+      url: A string, the originally requested URL.
+      contents: Bytes, the contents to write.
+      made_dirs: An optional set of the output directories already created. If
+        provided, it is used to avoid creating the same directories repeatedly,
+        and it is updated with the new directories.
+    """
     output_filename = path.join(output_dir,
                                 normalize_filename(url).lstrip('/'))
-    os.makedirs(path.dirname(output_filename), exist_ok=True)
+    output_dirname = path.dirname(output_filename)
+    if made_dirs is None or output_dirname not in made_dirs:
+        os.makedirs(output_dirname, exist_ok=True)
+        if made_dirs is not None:
+            made_dirs.add(output_dirname)
     with open(output_filename, 'wb') as outfile:
         outfile.write(contents)
 
 
+def save_scraped_document(output_dir, url, response, contents, html_root, skipped_urls,
+                          made_dirs=None):
+    """Callback function to process a document being scraped.
+
+    This converts the document to have relative links and writes out the file to
+    the output directory.
+
+    Args:
+      output_dir: A string, the output directory to write.
+      url: A string, the originally requested URL.
+      response: An http response as per urlopen.
+      contents: Bytes, the content of a response.
+      html_root: An lxml root node for the document, optionally. If this is provided,
+        this avoid you having to reprocess it (for performance reasons).
+      skipped_urls: A set of the links from the file that were skipped.
+      made_dirs: An optional set of the output directories already created. See
+        write_document().
+    """
+    contents = render_scraped_document(url, response, contents, html_root, skipped_urls)
+    if contents is not None:
+        write_document(output_dir, url, contents, made_dirs)
+
+
 def bake_to_directory(webargs, output_dir, render_all_pages=True):
     """Serve and bake a Beancount's web to a directory.
 
@@ -131,8 +263,6 @@ def bake_to_directory(webargs, output_dir, render_all_pages=True):
     Returns:
       True on success, False otherwise.
     """
-    callback = functools.partial(save_scraped_document, output_dir)
-
     if render_all_pages:
         ignore_regexps = None
     else:
@@ -150,7 +280,39 @@ def bake_to_directory(webargs, output_dir, render_all_pages=True):
         ]
         ignore_regexps = '({})'.format('|'.join(regexps))
 
-    processed_urls, skipped_urls = web.scrape_webapp(webargs, callback, ignore_regexps)
+    # Convert the pages on the scraper thread, reusing the tree it has already
+    # parsed (lxml trees should not be used from another thread), and write
+    # them out on worker threads while the scraper goes on fetching the next
+    # ones. The number of pages held in memory while they wait for a worker is
+    # bounded.
+    made_dirs = set()
+    futures = []
+    pending = threading.BoundedSemaphore(MAX_PENDING_DOCUMENTS)
+
+    def release(_):
+        "Free the slot of a document once it has been written out."
+        pending.release()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SAVE_WORKERS) as executor:
+        submit, add_future = executor.submit, futures.append
+
+        def callback(url, response, contents, html_root, skipped_urls):
+            "Convert a scraped document and queue it to be written out by a worker."
+            contents = render_scraped_document(url, response, contents, html_root,
+                                               skipped_urls)
+            if contents is None:
+                return
+            pending.acquire()
+            future = submit(write_document, output_dir, url, contents, made_dirs)
+            future.add_done_callback(release)
+            add_future(future)
+
+        processed_urls, skipped_urls = web.scrape_webapp(webargs, callback,
+                                                         ignore_regexps)
+
+    # Propagate errors from the workers.
+    for future in futures:
+        future.result()
 
 
 def archive(command_template, directory, archive, quiet=False):
@@ -191,12 +353,14 @@ def archive(command_template, directory, archive, quiet=False):
         raise OSError("Archive failure")
 
 
-def archive_zip(directory, archive):
+def archive_zip(directory, archive, remove=False):
     """Archive the directory to the given tar/gz archive filename.
 
     Args:
       directory: A string, the name of the directory to archive.
       archive: A string, the name of the file to output.
+      remove: A boolean, true to delete the files and the directory as they get
+        archived, instead of requiring another walk of the tree to do so.
     """
     # Figure out optimal level of compression among the supported ones in this
     # installation.
@@ -213,16 +377,42 @@ def archive_zip(directory, archive):
 
     with file_utils.chdir(directory), zipfile.ZipFile(
             archive, 'w', compression=zip_compression) as archfile:
-        for root, dirs, files in os.walk(directory):
+        # Walk bottom-up when removing, so directories are empty by the time
+        # we get to them.
+        for root, dirs, files in os.walk(directory, topdown=not remove):
             for filename in files:
                 relpath = path.relpath(path.join(root, filename), directory)
                 archfile.write(relpath)
+                if remove:
+                    os.remove(relpath)
+            if remove and root != directory:
+                os.rmdir(root)
+    if remove:
+        os.rmdir(directory)
+
+
+def tar_command(compress_flag, parallel_program):
+    """Build a tar command template, compressing on all cores if possible.
+
+    Args:
+      compress_flag: A string, the tar flag for the serial compressor.
+      parallel_program: A string, the name of a parallel compressor program
+        to use instead, if it is installed.
+    Returns:
+      A command template string for archive().
+    """
+    if shutil.which(parallel_program):
+        return ('tar -C {{dirname}} --use-compress-program={} '
+                '-cvf {{archive}} {{basename}}').format(parallel_program)
+    else:
+        return 'tar -C {{dirname}} -{}cvf {{archive}} {{basename}}'.format(
+            compress_flag)
 
 
 ARCHIVERS = {
-    '.tar.gz'  : 'tar -C {dirname} -zcvf {archive} {basename}',
-    '.tgz'     : 'tar -C {dirname} -zcvf {archive} {basename}',
-    '.tar.bz2' : 'tar -C {dirname} -jcvf {archive} {basename}',
+    '.tar.gz'  : tar_command('z', 'pigz'),
+    '.tgz'     : tar_command('z', 'pigz'),
+    '.tar.bz2' : tar_command('j', 'pbzip2'),
     '.zip'     : archive_zip,
     }
 
@@ -293,14 +483,13 @@ def main():
             raise IOError("Output archive name '{}' already exists".format(
                 archive_filename))
 
-        # Dispatch to a particular compressor.
+        # Dispatch to a particular compressor and delete the output directory.
+        # In-process archivers delete the files as they go.
         if isinstance(archival_command, str):
             archive(archival_command, output_directory, archive_filename, True)
+            shutil.rmtree(output_directory)
         elif callable(archival_command):
-            archival_command(output_directory, archive_filename)
-
-        # Delete the output directory.
-        shutil.rmtree(output_directory)
+            archival_command(output_directory, archive_filename, remove=True)
 
     print("Output in '{}'".format(opts.output))
 
@@ -6,6 +6,7 @@ import textwrap
 from os import path
 from unittest import mock
 import unittest
+import zipfile
 
 import lxml.html
 
@@ -30,6 +31,8 @@ class TestBakeFunctions(test_utils.TestCase):
     def test_normalize_untouched(self):
         # Existing extensions that shouldn't be touched.
         self.check('/path/to/file', '/path/to/file.html')
+        self.check('/path/to/file.html', '/path/to/file.html')
+        self.check('/resources/file.html', '/resources/file.html')
         self.check('/favicon.ico', '/favicon.ico')
         self.check('/resources/file.css', '/resources/file.css')
         self.check('/resources/file.js', '/resources/file.js')
@@ -39,6 +42,8 @@ class TestBakeFunctions(test_utils.TestCase):
         self.check('/path/to/file.csv', '/path/to/file.csv.html')
         self.check('/path/to/file.png', '/path/to/file.png.html')
         self.check('/link/tag.pdf', '/link/tag.pdf.html')
+        self.check('/path/favicon.ico', '/path/favicon.ico.html')
+        self.check('/path/resources/file.css', '/path/resources/file.css.html')
 
     def test_normalize_protected(self):
         # Unless they are in doc or third_party.
@@ -46,6 +51,18 @@ class TestBakeFunctions(test_utils.TestCase):
         self.check('/resources/file.png', '/resources/file.png')
         self.check('/third_party/file.csv', '/third_party/file.csv')
 
+    def test_fast_relpath(self):
+        for target, start in [('/path/to/file.html', '/path/to'),
+                              ('/path/to/file.html', '/path'),
+                              ('/path/file.html', '/path/to/sub'),
+                              ('/other/file.html', '/path/to'),
+                              ('/file.html', '/'),
+                              ('/path/to', '/path/to'),
+                              ('/path/to/', '/path//to/'),
+                              ('/path/../file.html', '/path/to')]:
+            self.assertEqual(path.relpath(target, start),
+                             bake._fast_relpath(target, start))
+
     test_html = textwrap.dedent("""
       <html>
         <body>
@@ -78,7 +95,7 @@ class TestBakeFunctions(test_utils.TestCase):
 
     def test_relativize_links(self):
         html = lxml.html.document_fromstring(self.test_html)
-        bake.relativize_links(html, '/path/to/index')
+        self.assertTrue(bake.relativize_links(html, '/path/to/index'))
         contents = lxml.html.tostring(html, method="html").decode('utf8')
         self.assertLines(self.expected_html, contents)
 
@@ -98,11 +115,25 @@ class TestBakeFunctions(test_utils.TestCase):
 
     def test_remove_links(self):
         html = lxml.html.document_fromstring(self.test_html)
-        bake.remove_links(html, {'/path/to/other',
-                                 '/path/to/sub/child'})
+        self.assertTrue(bake.remove_links(html, {'/path/to/other',
+                                                 '/path/to/sub/child'}))
+        contents = lxml.html.tostring(html, method="html").decode('utf8')
+        self.assertLines(self.nolinks_html, contents)
+
+    def test_remove_links__list(self):
+        html = lxml.html.document_fromstring(self.test_html)
+        self.assertTrue(bake.remove_links(html, ['/path/to/other',
+                                                 '/path/to/sub/child']))
         contents = lxml.html.tostring(html, method="html").decode('utf8')
         self.assertLines(self.nolinks_html, contents)
 
+    def test_unmodified_links(self):
+        html = lxml.html.document_fromstring(self.expected_html)
+        self.assertFalse(bake.relativize_links(html, '/path/to/index'))
+        self.assertFalse(bake.remove_links(html, {'/path/to/other'}))
+        contents = lxml.html.tostring(html, method="html").decode('utf8')
+        self.assertLines(self.expected_html, contents)
+
     def test_save_scraped_document__file(self):
         html = lxml.html.document_fromstring(self.test_html)
         with test_utils.tempdir() as tmp:
@@ -118,6 +149,66 @@ class TestBakeFunctions(test_utils.TestCase):
             self.assertTrue(path.exists(filename))
             self.assertLines(open(filename).read(), self.expected_html)
 
+    def test_save_scraped_document__parse(self):
+        with test_utils.tempdir() as tmp:
+            response = mock.MagicMock()
+            response.url = '/path/to/file'
+            response.status = 200
+            response.read.return_value = self.test_html.encode('utf8')
+            response.info().get_content_type.return_value = 'text/html'
+
+            # Process twice without a tree to exercise reusing the parser.
+            for _ in range(2):
+                bake.save_scraped_document(
+                    tmp, response.url, response, response.read.return_value, None, set())
+                filename = path.join(tmp, 'path/to/file.html')
+                self.assertLines(open(filename).read(), self.expected_html)
+
+    def test_absolute_link_search(self):
+        for contents in [b'<a href="/path">', b"<a href='/path'>", b'<a href=/path>',
+                         b'<a href = "/path">', b'<p style="background: URL(/x.png)">',
+                         b'<style>@import "/style.css";</style>']:
+            self.assertTrue(bake.ABSOLUTE_LINK_SEARCH(contents), contents)
+        for contents in [b'<a href="path">', b'<a href="../path">', b'<p>1/2</p>',
+                         b'<a href="http://example.com/path">']:
+            self.assertFalse(bake.ABSOLUTE_LINK_SEARCH(contents), contents)
+
+    def test_save_scraped_document__relative(self):
+        contents = textwrap.dedent("""
+          <!DOCTYPE html>
+          <html>
+            <body>
+              <a href="other.html">sibling file</a>
+            </body>
+          </html>
+        """).encode('utf8')
+        with test_utils.tempdir() as tmp:
+            response = mock.MagicMock()
+            response.status = 200
+            response.info().get_content_type.return_value = 'text/html'
+
+            with mock.patch.object(lxml.html, 'document_fromstring') as mock_parse:
+                bake.save_scraped_document(
+                    tmp, '/path/to/file', response, contents, None, set())
+                mock_parse.assert_not_called()
+            filename = path.join(tmp, 'path/to/file.html')
+            self.assertEqual(contents, open(filename, 'rb').read())
+
+    def test_save_scraped_document__made_dirs(self):
+        with test_utils.tempdir() as tmp:
+            response = mock.MagicMock()
+            response.status = 200
+            response.info().get_content_type.return_value = 'text/plain'
+
+            made_dirs = set()
+            for url in '/path/to/file1', '/path/to/file2', '/path/file3':
+                bake.save_scraped_document(
+                    tmp, url, response, b'TEXT', None, set(), made_dirs)
+            self.assertEqual({path.join(tmp, 'path/to'), path.join(tmp, 'path')},
+                             made_dirs)
+            self.assertTrue(path.exists(path.join(tmp, 'path/to/file2.html')))
+            self.assertTrue(path.exists(path.join(tmp, 'path/file3.html')))
+
     def test_save_scraped_document__ignore_directories(self):
         html = lxml.html.document_fromstring(self.test_html)
         with test_utils.tempdir() as tmp:
@@ -146,6 +237,71 @@ class TestBakeFunctions(test_utils.TestCase):
             actual_contents = open(path.join(tmp, 'resources/something.png'), 'rb').read()
             self.assertEqual(expected_contents, actual_contents)
 
+    def test_bake_to_directory__workers(self):
+        def scrape_webapp(webargs, callback, ignore_regexps):
+            for index in range(20):
+                response = mock.MagicMock()
+                response.status = 200
+                response.info().get_content_type.return_value = 'text/html'
+                callback('/path/to/file{}'.format(index), response,
+                         self.test_html.encode('utf8'), None, set())
+            return set(), set()
+
+        with test_utils.tempdir() as tmp:
+            with mock.patch.object(bake.web, 'scrape_webapp', scrape_webapp), \
+                 mock.patch.object(bake, 'MAX_PENDING_DOCUMENTS', 2):
+                bake.bake_to_directory(None, tmp)
+            self.assertEqual(20, len(os.listdir(path.join(tmp, 'path/to'))))
+            filename = path.join(tmp, 'path/to/file19.html')
+            self.assertLines(open(filename).read(), self.expected_html)
+
+    def test_bake_to_directory__scraper_tree(self):
+        html = lxml.html.document_fromstring(self.test_html)
+
+        def scrape_webapp(webargs, callback, ignore_regexps):
+            "Hand over a single page, with the tree parsed by the scraper."
+            response = mock.MagicMock()
+            response.status = 200
+            response.info().get_content_type.return_value = 'text/html'
+            callback('/path/to/file', response, b'<a href="/other">CONTENTS</a>', html,
+                     set())
+            return set(), set()
+
+        with mock.patch.object(bake.web, 'scrape_webapp', scrape_webapp), \
+             mock.patch.object(lxml.html, 'document_fromstring') as mock_parse, \
+             mock.patch.object(bake, 'write_document') as mock_write:
+            bake.bake_to_directory(None, '/output')
+        mock_parse.assert_not_called()
+        self.assertEqual(1, mock_write.call_count)
+        contents = mock_write.call_args[0][2]
+        self.assertIsInstance(contents, bytes)
+        self.assertLines(contents.decode('utf8'), self.expected_html)
+
+    def test_tar_command(self):
+        with mock.patch('shutil.which', return_value=None):
+            self.assertEqual('tar -C {dirname} -zcvf {archive} {basename}',
+                             bake.tar_command('z', 'pigz'))
+        with mock.patch('shutil.which', return_value='/usr/bin/pigz'):
+            self.assertEqual(
+                'tar -C {dirname} --use-compress-program=pigz -cvf {archive} {basename}',
+                bake.tar_command('z', 'pigz'))
+
+    def test_archive_zip__remove(self):
+        with test_utils.tempdir() as tmp:
+            directory = path.join(tmp, 'output')
+            os.makedirs(path.join(directory, 'path/to'))
+            os.makedirs(path.join(directory, 'empty'))
+            for filename in 'index.html', 'path/file.html', 'path/to/file.html':
+                with open(path.join(directory, filename), 'w') as outfile:
+                    outfile.write(filename)
+            archive = path.join(tmp, 'output.zip')
+            bake.archive_zip(directory, archive, remove=True)
+            self.assertFalse(path.exists(directory))
+            with zipfile.ZipFile(archive) as archfile:
+                self.assertEqual({'index.html', 'path/file.html', 'path/to/file.html'},
+                                 set(archfile.namelist()))
+                self.assertEqual(b'path/to/file.html', archfile.read('path/to/file.html'))
+
 
 class TestScriptBake(test_utils.TestCase):
 
@@ -26,24 +26,23 @@ def validate_directory(accounts, document_dir):
     """
     # Generate all parent accounts in the account_set we're checking against, so
     # that parent directories with no corresponding account don't warn.
+    # Parents are taken as prefixes of the name, so each account is sliced
+    # rather than split and rejoined at every level.
     accounts_with_parents = set(accounts)
     for account_ in accounts:
-        while True:
-            parent = account.parent(account_)
-            if not parent:
-                break
+        index = account_.rfind(account.sep)
+        while index > 0:
+            parent = account_[:index]
             if parent in accounts_with_parents:
                 break
             accounts_with_parents.add(parent)
-            account_ = parent
+            index = account_.rfind(account.sep, 0, index)
 
-    errors = []
-    for directory, account_name, _, _ in account.walk(document_dir):
-        if account_name not in accounts_with_parents:
-            errors.append(ValidateDirectoryError(
+    return [ValidateDirectoryError(
                 "Invalid directory '{}': no corresponding account '{}'".format(
-                    directory, account_name)))
-    return errors
+                    directory, account_name))
+            for directory, account_name, _, _ in account.walk(document_dir)
+            if account_name not in accounts_with_parents]
 
 
 def validate_directories(entries, document_dirs):
@@ -19,7 +19,6 @@ from os import path
 # Import what you need as late as possible.
 from beancount.utils import misc_utils
 from beancount.utils import version
-from beancount.core import display_context
 
 
 # pylint: disable=import-outside-toplevel
@@ -32,9 +31,16 @@ def do_lex(filename, unused_args):
       filename: A string, the Beancount input filename.
     """
     from beancount.parser import lexer
+    # Write the output in batches of lines rather than once per token.
+    writelines = sys.stdout.writelines
+    lines = []
     for token, lineno, text, obj in lexer.lex_iter(filename):
-        sys.stdout.write('{:12} {:6d} {}\n'.format(
-            '(None)' if token is None else token, lineno, repr(text)))
+        lines.append('{:12} {:6d} {!r}\n'.format(
+            '(None)' if token is None else token, lineno, text))
+        if len(lines) >= 4096:
+            writelines(lines)
+            lines.clear()
+    writelines(lines)
 
 do_dump_lexer = do_lex
 
@@ -49,6 +55,18 @@ def do_parse(filename, unused_args):
     entries, errors, _ = parser.parse_file(filename, yydebug=1)
 
 
+def _print_entries_to_file(entries, filename):
+    """Print a list of entries to a file, through a large write buffer.
+
+    Args:
+      entries: A list of directives.
+      filename: A string, the name of the file to write.
+    """
+    from beancount.parser import printer
+    with open(filename, 'w', buffering=2**20) as outfile:
+        printer.print_entries(entries, file=outfile)
+
+
 def do_roundtrip(filename, unused_args):
     """Round-trip test on arbitrary Ledger.
 
@@ -59,6 +77,7 @@ def do_roundtrip(filename, unused_args):
     Args:
       filename: A string, the Beancount input filename.
     """
+    from concurrent import futures
     from beancount.parser import printer
     from beancount.core import compare
     from beancount import loader
@@ -73,8 +92,7 @@ def do_roundtrip(filename, unused_args):
         logging.info("Print them out to a file")
         basename, extension = path.splitext(filename)
         round1_filename = ''.join([basename, '.roundtrip1', extension])
-        with open(round1_filename, 'w') as outfile:
-            printer.print_entries(entries, file=outfile)
+        _print_entries_to_file(entries, round1_filename)
 
         logging.info("Read the entries from that file")
 
@@ -94,33 +112,41 @@ def do_roundtrip(filename, unused_args):
 
         logging.info("Print what you read to yet another file")
         round2_filename = ''.join([basename, '.roundtrip2', extension])
-        with open(round2_filename, 'w') as outfile:
-            printer.print_entries(entries_roundtrip, file=outfile)
-
-        logging.info("Compare the original entries with the re-read ones")
-        same, missing1, missing2 = compare.compare_entries(entries, entries_roundtrip)
+        with futures.ThreadPoolExecutor(max_workers=1) as executor:
+            # Nothing reads the second file back, so write it out in the
+            # background while the entries get compared.
+            written = executor.submit(_print_entries_to_file,
+                                      entries_roundtrip, round2_filename)
+
+            logging.info("Compare the original entries with the re-read ones")
+            same, missing1, missing2 = compare.compare_entries(entries, entries_roundtrip)
+            written.result()
         if same:
             logging.info('Entries are the same. Congratulations.')
         else:
             logging.error('Entries differ!')
             print()
             print('\n\nMissing from original:')
-            for entry in entries:
+            for entry in missing2:
                 print(entry)
                 print(compare.hash_entry(entry))
                 print(printer.format_entry(entry))
                 print()
 
             print('\n\nMissing from round-trip:')
-            for entry in missing2:
+            for entry in missing1:
                 print(entry)
                 print(compare.hash_entry(entry))
                 print(printer.format_entry(entry))
                 print()
     finally:
         for rfilename in (round1_filename, round2_filename):
-            if path.exists(rfilename):
+            if rfilename is None:
+                continue
+            try:
                 os.remove(rfilename)
+            except FileNotFoundError:
+                pass
 
 
 def do_directories(filename, args):
@@ -159,8 +185,8 @@ def do_print_options(filename, *args):
     """
     from beancount import loader
     _, __, options_map = loader.load_file(filename)
-    for key, value in sorted(options_map.items()):
-        print('{}: {}'.format(key, value))
+    sys.stdout.write(''.join('{}: {}\n'.format(key, options_map[key])
+                             for key in sorted(options_map)))
 
 
 def get_commands():
@@ -169,13 +195,9 @@ def get_commands():
     Returns:
       A list of pairs of (command-name string, docstring).
     """
-    commands = []
-    for attr_name, attr_value in globals().items():
-        match = re.match('do_(.*)', attr_name)
-        if match:
-            commands.append((match.group(1),
-                             misc_utils.first_paragraph(attr_value.__doc__)))
-    return commands
+    return [(attr_name[3:], misc_utils.first_paragraph(attr_value.__doc__))
+            for attr_name, attr_value in globals().items()
+            if attr_name.startswith('do_')]
 
 
 def do_deps(*unused_args):
@@ -244,6 +266,7 @@ def do_linked(filename, args):
     from beancount.parser import options
     from beancount.parser import printer
     from beancount.core import account_types
+    from beancount.core import display_context
     from beancount.core import inventory
     from beancount.core import data
     from beancount.core import realization
@@ -277,27 +300,32 @@ def do_linked(filename, args):
         # links. Best would be to query the user (in Emacs) when there are many
         # links present.
         follow_links = True
+
+        # Index the transactions by link.
+        link_index = collections.defaultdict(list)
+        for entry in entries:
+            if isinstance(entry, data.Transaction) and entry.links:
+                for link in entry.links:
+                    link_index[link].append(entry)
+
         if not follow_links:
-            linked_entries = [entry
-                              for entry in entries
-                              if (isinstance(entry, data.Transaction) and
-                                  entry.links and
-                                  entry.links & links)]
+            linked_ids = {id(entry) for link in links for entry in link_index[link]}
         else:
-            links = set(links)
-            linked_entries = []
-            while True:
-                num_linked = len(linked_entries)
-                linked_entries = [entry
-                                  for entry in entries
-                                  if (isinstance(entry, data.Transaction) and
-                                      entry.links and
-                                      entry.links & links)]
-                if len(linked_entries) == num_linked:
-                    break
-                for entry in linked_entries:
-                    if entry.links:
-                        links.update(entry.links)
+            linked_ids = set()
+            seen_links = set(links)
+            pending_links = list(links)
+            while pending_links:
+                for entry in link_index[pending_links.pop()]:
+                    if id(entry) in linked_ids:
+                        continue
+                    linked_ids.add(id(entry))
+                    for link in entry.links:
+                        if link not in seen_links:
+                            seen_links.add(link)
+                            pending_links.append(link)
+
+        # Keep the original order of the entries.
+        linked_entries = [entry for entry in entries if id(entry) in linked_ids]
 
     # Render linked entries (in date order) as errors (for Emacs).
     errors = [RenderError(entry.meta, '', entry)
@@ -312,10 +340,13 @@ def do_linked(filename, args):
 
     # Print out net income change.
     acctypes = options.get_account_types(options_map)
+    is_income_statement_account = account_types.is_income_statement_account
     net_income = inventory.Inventory()
-    for real_node in realization.iter_children(real_root):
-        if account_types.is_income_statement_account(real_node.account, acctypes):
-            net_income.add_inventory(real_node.balance)
+    add_inventory = net_income.add_inventory
+    for balance in [real_node.balance
+                    for real_node in realization.iter_children(real_root)
+                    if is_income_statement_account(real_node.account, acctypes)]:
+        add_inventory(balance)
 
     print()
     print('Net Income: {}'.format(-net_income))
@@ -343,12 +374,11 @@ def do_missing_open(filename, args):
     first_use_map, _ = getters.get_accounts_use_map(entries)
     open_close_map = getters.get_account_open_close(entries)
 
-    new_entries = []
-    for account, first_use_date in first_use_map.items():
-        if account not in open_close_map:
-            new_entries.append(
-                data.Open(data.new_metadata(filename, 0), first_use_date, account,
-                          None, None))
+    # Note: The new entries are only printed, so they can share their metadata.
+    meta = data.new_metadata(filename, 0)
+    new_entries = [data.Open(meta, first_use_date, account, None, None)
+                   for account, first_use_date in first_use_map.items()
+                   if account not in open_close_map]
 
     dcontext = options_map['dcontext']
     printer.print_entries(data.sorted(new_entries), dcontext)
@@ -365,7 +395,7 @@ def do_display_context(filename, args):
     from beancount import loader
     entries, errors, options_map = loader.load_file(filename)
     dcontext = options_map['dcontext']
-    sys.stdout.write(str(dcontext))
+    sys.stdout.writelines(dcontext.iter_lines())
 
 
 def do_validate_html(directory, args):
@@ -6,6 +6,7 @@ import re
 import textwrap
 import tempfile
 from os import path
+from unittest import mock
 import unittest
 
 from beancount.parser import cmptest
@@ -76,11 +77,50 @@ class TestScriptDoctor(test_utils.TestCase):
         with test_utils.capture('stdout', 'stderr'):
             test_utils.run_with_args(doctor.main, ['roundtrip', filename])
 
+    @test_utils.docfile
+    def test_dump_roundtrip_differ(self, filename):
+        """
+        2013-01-01 open Expenses:Restaurant
+        2013-01-01 open Assets:Cash
+
+        2014-03-02 * "Something"
+          Expenses:Restaurant   50.02 USD
+          Assets:Cash
+        """
+        # Drop the transaction from the first printed file, so that it goes
+        # missing from the round-trip.
+        print_entries = doctor._print_entries_to_file
+
+        def print_entries_dropping(entries, filename):
+            "Print the entries, without the last one in the first file."
+            print_entries(entries if 'roundtrip2' in filename else entries[:-1],
+                          filename)
+
+        with test_utils.capture('stdout', 'stderr') as (stdout, _), \
+             mock.patch.object(doctor, '_print_entries_to_file', print_entries_dropping):
+            test_utils.run_with_args(doctor.main, ['roundtrip', filename])
+        original, roundtrip = stdout.getvalue().split('Missing from round-trip:')
+        self.assertIn('Missing from original:', original)
+        self.assertNotIn('Something', original)
+        self.assertIn('Something', roundtrip)
+
     def test_list_options(self):
         with test_utils.capture():
             test_utils.run_with_args(doctor.main, ['list_options'])
             test_utils.run_with_args(doctor.main, ['list-options'])
 
+    @test_utils.docfile
+    def test_print_options(self, filename):
+        """
+        option "title" "Ledger Title"
+        """
+        with test_utils.capture() as stdout:
+            test_utils.run_with_args(doctor.main, ['print-options', filename])
+        output = stdout.getvalue()
+        self.assertIn('title: Ledger Title', output.splitlines())
+        self.assertLess(output.index('account_current_conversions:'),
+                        output.index('title:'))
+
     def test_deps(self):
         with test_utils.capture():
             test_utils.run_with_args(doctor.main, ['deps'])
@@ -252,6 +292,34 @@ class TestScriptContextualCommands(cmptest.TestCase):
         self.assertEqual(2, len(list(re.finditer(r'/(tmp|var/folders)/.*:\d+:',
                                                  stdout.getvalue()))))
 
+    @test_utils.docfile
+    def test_linked_transitive(self, filename):
+        """
+            2013-01-01 open Expenses:Movie
+            2013-01-01 open Assets:Cash
+
+            2014-03-03 * "Apples" ^abc
+              Expenses:Movie        25.00 USD
+              Assets:Cash
+
+            2014-04-04 * "Bananas" ^abc ^def
+              Expenses:Movie        25.00 USD
+              Assets:Cash
+
+            2014-05-05 * "Cherries" ^def
+              Expenses:Movie        25.00 USD
+              Assets:Cash
+
+            2014-06-06 * "Dates" ^ghi
+              Expenses:Movie        25.00 USD
+              Assets:Cash
+        """
+        with test_utils.capture() as stdout:
+            test_utils.run_with_args(doctor.main, ['linked', filename, '5'])
+        output = stdout.getvalue()
+        self.assertRegex(output, 'Apples(.|\n)*Bananas(.|\n)*Cherries')
+        self.assertNotRegex(output, 'Dates')
+
 
 if __name__ == '__main__':
     unittest.main()
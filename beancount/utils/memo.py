@@ -3,7 +3,8 @@
 __copyright__ = "Copyright (C) 2015-2017  Martin Blais"
 __license__ = "GNU GPLv2"
 
-import shelve
+import collections
+import sqlite3
 import threading
 import hashlib
 import datetime
@@ -11,6 +12,19 @@ import functools
 import io
 
 
+# A fast hash for the cache keys. This does not need to be cryptographic.
+# Note: BLAKE2 is only available from Python 3.6.
+if hasattr(hashlib, 'blake2b'):
+    new_key_hash = functools.partial(hashlib.blake2b, digest_size=16)
+else:
+    new_key_hash = hashlib.md5
+
+
+# The number of recently used results to keep in memory, in front of the
+# on-disk cache.
+RECENT_SIZE = 512
+
+
 def now():
     "Indirection on datetime.datetime.now() for testing."
     return datetime.datetime.now()
@@ -19,7 +33,8 @@ def now():
 def memoize_recent_fileobj(function, cache_filename, expiration=None):
     """Memoize recent calls to the given function which returns a file object.
 
-    The results of the cache expire after some time.
+    The results of the cache expire after some time. They are stored in an
+    SQLite database, and the most recently used ones are also kept in memory.
 
     Args:
       function: A callable object.
@@ -29,29 +44,73 @@ def memoize_recent_fileobj(function, cache_filename, expiration=None):
     Returns:
       A memoized version of the function.
     """
-    urlcache = shelve.open(cache_filename, 'c')
-    urlcache.lock = threading.Lock()  # Note: 'shelve' is not thread-safe.
+    # Note: Each thread gets its own connection to the database, so only the
+    # in-memory results are shared and need a lock. The lock is never held
+    # while querying the database or calling the function.
+    local = threading.local()
+    lock = threading.Lock()
+    recent = collections.OrderedDict()
+
+    def get_connection():
+        "Return the database connection of the calling thread."
+        try:
+            return local.connection
+        except AttributeError:
+            connection = local.connection = sqlite3.connect(cache_filename,
+                                                            isolation_level=None)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            return connection
+
+    connection = get_connection()
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS cache '
+                       '(key BLOB PRIMARY KEY, time REAL, contents BLOB)')
+
+    def remember(hash_, value):
+        "Insert a result in the in-memory cache."
+        with lock:
+            recent[hash_] = value
+            recent.move_to_end(hash_)
+            if len(recent) > RECENT_SIZE:
+                recent.popitem(last=False)
+
+    def lookup(hash_):
+        "Return the cached (time, contents) pair for a key, or None."
+        with lock:
+            value = recent.get(hash_)
+            if value is not None:
+                recent.move_to_end(hash_)
+                return value
+        row = get_connection().execute('SELECT time, contents FROM cache WHERE key = ?',
+                                       (hash_,)).fetchone()
+        if row is None:
+            return None
+        value = (datetime.datetime.fromtimestamp(row[0]), row[1])
+        remember(hash_, value)
+        return value
+
+    def store(hash_, time_now, contents):
+        "Save a new result to both caches."
+        get_connection().execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                                 (hash_, time_now.timestamp(), contents))
+        remember(hash_, (time_now, contents))
+
     @functools.wraps(function)
     def memoized(*args, **kw):
-        # Encode the arguments, including a date string in order to invalidate
-        # results over some time.
-        md5 = hashlib.md5()
-        md5.update(str(args).encode('utf-8'))
-        md5.update(str(sorted(kw.items())).encode('utf-8'))
-
-        hash_ = md5.hexdigest()
+        # Encode the arguments. Results are invalidated over time by comparing
+        # against the time they were stored at, not by the key.
+        key_hash = new_key_hash(repr((args, sorted(kw.items()))).encode('utf-8'))
+        hash_ = key_hash.digest()
         time_now = now()
-        try:
-            with urlcache.lock:
-                time_orig, contents = urlcache[hash_]
-            if expiration is not None and (time_now - time_orig) > expiration:
-                raise KeyError
-        except KeyError:
+        value = lookup(hash_)
+        if value is not None and (expiration is None or
+                                  (time_now - value[0]) <= expiration):
+            contents = value[1]
+        else:
             fileobj = function(*args, **kw)
             if fileobj:
                 contents = fileobj.read()
-                with urlcache.lock:
-                    urlcache[hash_] = (time_now, contents)
+                store(hash_, time_now, contents)
             else:
                 contents = None
 
@@ -5,6 +5,7 @@ import datetime
 import unittest
 import tempfile
 import io
+from concurrent import futures
 from os import path
 from unittest import mock
 
@@ -47,6 +48,42 @@ class TestMemoization(unittest.TestCase):
             # Make sure to close before the test directory goes away.
             del mem_function
 
+    def test_memoization_persistent(self):
+        function = mock.MagicMock(return_value=io.BytesIO(b'Payload'))
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = path.join(tmp, 'cache.db')
+            mem_function = memo.memoize_recent_fileobj(function, filename)
+            self.assertEqual(b'Payload', mem_function('a').read())
+            del mem_function
+
+            # A new instance reads the results back from the file.
+            mem_function = memo.memoize_recent_fileobj(function, filename)
+            self.assertEqual(b'Payload', mem_function('a').read())
+            del mem_function
+
+        self.assertEqual(1, function.call_count)
+
+    def test_memoization_recent_size(self):
+        function = mock.MagicMock(side_effect=lambda arg: io.BytesIO(arg.encode()))
+        with tempfile.TemporaryDirectory() as tmp, \
+             mock.patch.object(memo, 'RECENT_SIZE', 2):
+            mem_function = memo.memoize_recent_fileobj(function, path.join(tmp, 'cache.db'))
+            for arg in 'abcab':
+                self.assertEqual(arg.encode(), mem_function(arg).read())
+            del mem_function
+
+        self.assertEqual(3, function.call_count)
+
+    def test_memoization_threads(self):
+        function = mock.MagicMock(side_effect=lambda arg: io.BytesIO(arg.encode()))
+        with tempfile.TemporaryDirectory() as tmp:
+            mem_function = memo.memoize_recent_fileobj(function, path.join(tmp, 'cache.db'))
+            args = [str(index % 10) for index in range(100)]
+            with futures.ThreadPoolExecutor(max_workers=4) as executor:
+                results = list(executor.map(lambda arg: mem_function(arg).read(), args))
+            self.assertEqual([arg.encode() for arg in args], results)
+            del mem_function
+
 
 if __name__ == '__main__':
     unittest.main()
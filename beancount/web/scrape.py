@@ -2,6 +2,7 @@ __copyright__ = "Copyright (C) 2015-2016  Martin Blais"
 __license__ = "GNU GPLv2"
 
 from os import path
+import functools
 import re
 import urllib.request
 import urllib.parse
@@ -116,7 +117,7 @@ def scrape_urls(url_format, callback, ignore_regexp=None):
     return all_processed_urls, all_skipped_urls
 
 
-def validate_local_links(filename):
+def validate_local_links(filename, exists=path.exists):
     """Open and parse the given HTML filename and verify all local targets exist.
 
     This checks that all the files pointed to by the file we're processing are
@@ -125,6 +126,8 @@ def validate_local_links(filename):
 
     Args:
       filename: A string, the name of the HTML file to process.
+      exists: A predicate function used to check whether a target filename
+        exists. Override this to share cached results across files.
     Returns:
       A pair of:
         missing: A set of strings, the names of links to files that do not exist.
@@ -145,7 +148,7 @@ def validate_local_links(filename):
                 if path.isabs(urlpath.path):
                     continue
                 target = path.normpath(path.join(filedir, urlpath.path))
-                if not path.exists(target):
+                if not exists(target):
                     missing.add(target)
 
     return missing, empty
@@ -164,6 +167,8 @@ def validate_local_links_in_dir(directory):
     """
     logging.basicConfig(level=logging.INFO,
                         format='%(levelname)-8s: %(message)s')
+    # Most pages link to the same set of targets; check each of them only once.
+    exists = functools.lru_cache(maxsize=None)(path.exists)
     allfiles = []
     missing, empty = set(), set()
     for root, dirs, files in os.walk(directory):
@@ -171,7 +176,7 @@ def validate_local_links_in_dir(directory):
             afilename = path.join(root, filename)
             allfiles.append(afilename)
             logging.info("Validating: '%s'", afilename)
-            missing, is_empty = validate_local_links(afilename)
+            missing, is_empty = validate_local_links(afilename, exists)
             if is_empty:
                 empty.add(afilename)
     return allfiles, missing, empty
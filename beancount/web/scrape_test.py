@@ -128,6 +128,16 @@ class TestScrapeVerification(test_utils.TestCase):
             self.assertTrue(all(re.search('_not', filename)
                                 for filename in missing))
 
+    def test_validate_local_links__exists(self):
+        with test_utils.tempdir() as tmpdir:
+            filename = path.join(tmpdir, 'start.html')
+            with open(filename, 'w') as ffile:
+                ffile.write('<html><body><a href="other.html">Other</a></body></html>')
+            exists = mock.MagicMock(return_value=False)
+            missing, empty = scrape.validate_local_links(filename, exists)
+            exists.assert_called_once_with(path.join(tmpdir, 'other.html'))
+            self.assertEqual({path.join(tmpdir, 'other.html')}, missing)
+
     def test_validate_local_links__empty(self):
         with test_utils.tempdir() as tmpdir:
             filename = path.join(tmpdir, 'start.html')